@@ -70,9 +70,20 @@ options:
         long as the name is unique.
     required: false
     default: False
+  cache_ttl:
+    description:
+      - Number of seconds the list of certificate names and digests of their bodies are cached on disk and reused by
+        later runs of this module against the same AWS account. This saves a listing call per task, and fetching
+        every certificate body for the duplicate check, when looping over many certificates.
+      - The account is looked up with sts:GetCallerIdentity. If that fails, a warning is given and no cache is used.
+      - Certificates this module uploads, renames or deletes are updated in the cache. Changes made outside of this
+        module are not noticed until the cache expires.
+    required: false
+    default: 0
+    version_added: "2.4"
 
 
-requirements: [ "boto" ]
+requirements: [ "boto3", "botocore" ]
 author: Jonathan I. Davila
 extends_documentation_fragment:
     - aws
@@ -88,6 +99,15 @@ EXAMPLES = '''
     key: "{{ lookup('file', 'path/to/key') }}"
     cert_chain: "{{ lookup('file', 'path/to/certchain') }}"
 
+# Upload many certificates, listing the existing ones only once a minute
+- iam_cert:
+    name: "{{ item.name }}"
+    state: present
+    cert: "{{ lookup('file', item.cert) }}"
+    key: "{{ lookup('file', item.key) }}"
+    cache_ttl: 60
+  with_items: "{{ server_certs }}"
+
 # Server certificate upload using key string
 - iam_cert:
     name: very_ssl
@@ -97,126 +117,265 @@ EXAMPLES = '''
     key: vault_body_of_privcertkey
     cert_chain: body_of_myverytrustedchain
 '''
+import fcntl
 import json
-import sys
+import os
+import time
+import traceback
+import unicodedata
+from contextlib import contextmanager
+from hashlib import sha256
+from multiprocessing.pool import ThreadPool
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ec2 import boto3_conn, camel_dict_to_snake_dict, ec2_argument_spec, get_aws_connection_info
+from ansible.module_utils.ec2 import HAS_BOTO3
+from ansible.module_utils._text import to_native, to_text
+
 try:
-    import boto
-    import boto.iam
-    import boto.ec2
-    HAS_BOTO = True
+    import botocore.exceptions
 except ImportError:
-    HAS_BOTO = False
-
-def boto_exception(err):
-    '''generic error message handler'''
-    if hasattr(err, 'error_message'):
-        error = err.error_message
-    elif hasattr(err, 'message'):
-        error = err.message
-    else:
-        error = '%s: %s' % (Exception, err)
-
-    return error
-
-def cert_meta(iam, name):
-    opath       = iam.get_server_certificate(name).get_server_certificate_result.\
-        server_certificate.\
-        server_certificate_metadata.\
-        path
-    ocert       = iam.get_server_certificate(name).get_server_certificate_result.\
-                                                 server_certificate.\
-                                                 certificate_body
-    ocert_id    = iam.get_server_certificate(name).get_server_certificate_result.\
-                                                 server_certificate.\
-                                                 server_certificate_metadata.\
-                                                 server_certificate_id
-    upload_date = iam.get_server_certificate(name).get_server_certificate_result.\
-                                                 server_certificate.\
-                                                 server_certificate_metadata.\
-                                                 upload_date
-    exp         = iam.get_server_certificate(name).get_server_certificate_result.\
-                                                 server_certificate.\
-                                                 server_certificate_metadata.\
-                                                 expiration
+    pass  # caught by imported HAS_BOTO3
+
+def cache_path(account_id):
+    '''path of the certificate listing cache for this AWS account'''
+    # IAM is global, so the account alone decides which certificates are listed
+    return os.path.join(os.path.expanduser('~/.ansible/tmp'), 'iam_cert_cache_%s.json' % account_id)
+
+def load_cache(path, ttl):
+    '''return the cache stored at path if it is younger than ttl seconds, else a new empty one'''
+    try:
+        with open(path) as f:
+            stored = json.load(f)
+        if time.time() - stored['created'] <= ttl:
+            return dict(path=path, ttl=ttl, created=stored['created'], serial=stored['serial'],
+                        names=stored['names'], digests=dict(stored['digests']))
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    # a serial of 0 marks a cache that is not on disk
+    return dict(path=path, ttl=ttl, created=time.time(), serial=0, names=None, digests={})
+
+def save_cache(cache):
+    cache['serial'] += 1
+    tmp_path = '%s.%d' % (cache['path'], os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(created=cache['created'], serial=cache['serial'], names=cache['names'],
+                           digests=cache['digests']), f)
+        os.rename(tmp_path, cache['path'])
+    except (IOError, OSError):
+        pass
+
+def cache_unchanged(current, cache):
+    '''whether current, as just read from disk, is still what cache was loaded from'''
+    return current['serial'] == cache['serial'] and (cache['serial'] == 0 or current['created'] == cache['created'])
+
+@contextmanager
+def locked_cache(cache):
+    '''lock the cache file against other runs and yield it as it is on disk now, or None if it cannot be locked'''
+    try:
+        if not os.path.isdir(os.path.dirname(cache['path'])):
+            os.makedirs(os.path.dirname(cache['path']))
+        lock = open(cache['path'] + '.lock', 'a')
+    except (IOError, OSError):
+        yield None
+        return
+    try:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        except (IOError, OSError):
+            # e.g. ENOLCK on some network filesystems; the certificate change itself already succeeded
+            yield None
+        else:
+            yield load_cache(cache['path'], cache['ttl'])
+    finally:
+        lock.close()
+
+def save_listing(cache, names):
+    '''store a listing in the cache, unless another run changed the cache since this one loaded it'''
+    with locked_cache(cache) as current:
+        # the change recorded meanwhile may be missing from this listing, which would then hide it until expiry
+        if current is not None and cache_unchanged(current, cache):
+            current['names'] = names
+            save_cache(current)
+            cache.update(serial=current['serial'], created=current['created'])
+
+def record_change(cache, removed=(), added=None):
+    '''update the cache, if any, after this module removed certificates or added them with their digests'''
+    if cache is None:
+        return
+    with locked_cache(cache) as current:
+        if current is None:
+            return
+        # digests computed by this run are only kept if no other run changed the cache meanwhile, as they
+        # could belong to certificates that run has since deleted
+        if cache_unchanged(current, cache):
+            current['digests'].update(cache['digests'])
+        # the change is already done in IAM, so it holds whether the cached list was taken before or after it
+        added = added or {}
+        if current['names'] is not None:
+            current['names'] = [n for n in current['names'] if n not in removed and n not in added] + list(added)
+        for name in removed:
+            current['digests'].pop(name, None)
+        current['digests'].update((n, d) for n, d in added.items() if d is not None)
+        save_cache(current)
+
+def iter_cert_names(iam):
+    '''yield the names of all server certificates, requesting further pages only as needed'''
+    paginator = iam.get_paginator('list_server_certificates')
+    for page in paginator.paginate():
+        for metadata in page['ServerCertificateMetadataList']:
+            yield metadata['ServerCertificateName']
+
+def list_cert_names(iam, stop_at=None):
+    '''return the names of the server certificates, listing no further once stop_at has been seen'''
+    names = []
+    for cert_name in iter_cert_names(iam):
+        names.append(cert_name)
+        if cert_name == stop_at:
+            break
+    return names
+
+def cert_getter(iam):
+    '''return a function fetching server certificates by name, fetching each at most once'''
+    certificates = {}
+
+    def get_cert(name):
+        if name not in certificates:
+            certificates[name] = iam.get_server_certificate(ServerCertificateName=name)['ServerCertificate']
+        return certificates[name]
+
+    return get_cert
+
+def cert_meta(get_cert, name):
+    certificate = get_cert(name)
+    ocert = certificate['CertificateBody']
+    opath = certificate['ServerCertificateMetadata']['Path']
+    ocert_id = certificate['ServerCertificateMetadata']['ServerCertificateId']
+    upload_date = certificate['ServerCertificateMetadata']['UploadDate']
+    exp = certificate['ServerCertificateMetadata']['Expiration']
     return opath, ocert, ocert_id, upload_date, exp
 
-def dup_check(module, iam, name, new_name, cert, orig_cert_names, orig_cert_bodies, dup_ok):
-    update=False
-    if any(ct in orig_cert_names for ct in [name, new_name]):
-        for i_name in [name, new_name]:
-            if i_name is None:
-                continue
-
-            if cert is not None:
-                try:
-                    c_index=orig_cert_names.index(i_name)
-                except NameError:
-                    continue
-                else:
-                    # NOTE: remove the carriage return to strictly compare the cert bodies.
-                    slug_cert = cert.replace('\r', '')
-                    slug_orig_cert_bodies = orig_cert_bodies[c_index].replace('\r', '')
-                    if slug_orig_cert_bodies == slug_cert:
-                        update=True
-                        break
-                    elif slug_orig_cert_bodies != slug_cert:
-                        module.fail_json(changed=False, msg='A cert with the name %s already exists and'
-                                                           ' has a different certificate body associated'
-                                                           ' with it. Certificates cannot have the same name' % i_name)
-            else:
-                update=True
-                break
-    elif cert in orig_cert_bodies and not dup_ok:
-        for crt_name, crt_body in zip(orig_cert_names, orig_cert_bodies):
-            if crt_body == cert:
-                module.fail_json(changed=False, msg='This certificate already'
-                                                    ' exists under the name %s' % crt_name)
+def cert_slug(cert):
+    '''return cert in the form certificate bodies are compared in'''
+    # NOTE: remove the carriage return, byte order mark and surrounding whitespace to strictly compare the
+    # cert bodies, so the same certificate read from a differently saved file is still recognised.
+    cert = unicodedata.normalize('NFC', to_text(cert))
+    return cert.replace(u'\r', u'').lstrip(u'\ufeff').strip()
+
+def cert_digest(cert):
+    '''return the digest certificate bodies are compared by'''
+    return sha256(cert_slug(cert).encode('utf-8')).hexdigest()
+
+def cert_digest_getter(get_cert, digests):
+    '''return a function returning certificate body digests by name, computing each at most once
+
+    digests holds the digests already known by name, and is filled in as more are computed.
+    '''
+    def get_cert_digest(name):
+        if name not in digests:
+            digests[name] = cert_digest(get_cert(name)['CertificateBody'])
+        return digests[name]
+
+    return get_cert_digest
+
+def iter_cert_digests(get_cert_digest, names, workers=4):
+    '''yield (name, digest) pairs in order, fetching the bodies concurrently'''
+    if len(names) < 2:
+        for name in names:
+            yield name, get_cert_digest(name)
+        return
 
-    return update
+    pool = ThreadPool(min(workers, len(names)))
+    try:
+        for name, digest in zip(names, pool.imap(get_cert_digest, names)):
+            yield name, digest
+    finally:
+        pool.terminate()
+
+def find_cert_by_digest(get_cert_digest, names, digest):
+    '''return the name of the first certificate whose body has this digest, or None'''
+    # bodies are only fetched here, stopping at the first match
+    matches = (name for name, body_digest in iter_cert_digests(get_cert_digest, names) if body_digest == digest)
+    return next(matches, None)
+
+def dup_check(module, name, new_name, cert, orig_cert_names, get_cert_digest, dup_ok):
+    '''return name or new_name if the certificate already exists under it, None if it is to be uploaded'''
+    existing_names = set(orig_cert_names)
+    digest = cert_digest(cert) if cert is not None else None
+    for i_name in [name, new_name]:
+        if i_name is None or i_name not in existing_names:
+            continue
+        if cert is None or get_cert_digest(i_name) == digest:
+            return i_name
+        module.fail_json(changed=False, msg='A cert with the name %s already exists and'
+                                           ' has a different certificate body associated'
+                                           ' with it. Certificates cannot have the same name' % i_name)
+
+    if cert is not None and not dup_ok:
+        crt_name = find_cert_by_digest(get_cert_digest, orig_cert_names, digest)
+        if crt_name is not None:
+            module.fail_json(changed=False, msg='This certificate already'
+                                                ' exists under the name %s' % crt_name)
+
+    return None
 
 
 def cert_action(module, iam, name, cpath, new_name, new_path, state,
-                cert, key, chain, orig_cert_names, orig_cert_bodies, dup_ok):
+                cert, key, chain, orig_cert_names, get_cert, dup_ok, cache=None):
     if state == 'present':
-        update = dup_check(module, iam, name, new_name, cert, orig_cert_names,
-                           orig_cert_bodies, dup_ok)
-        if update:
-            opath, ocert, ocert_id, upload_date, exp = cert_meta(iam, name)
-            changed=True
-            if new_name and new_path:
-                iam.update_server_cert(name, new_cert_name=new_name, new_path=new_path)
-                module.exit_json(changed=changed, original_name=name, new_name=new_name,
-                                 original_path=opath, new_path=new_path, cert_body=ocert,
-                                 upload_date=upload_date, expiration_date=exp)
-            elif new_name and not new_path:
-                iam.update_server_cert(name, new_cert_name=new_name)
-                module.exit_json(changed=changed, original_name=name, new_name=new_name,
-                                 cert_path=opath, cert_body=ocert,
-                                 upload_date=upload_date, expiration_date=exp)
-            elif not new_name and new_path:
-                iam.update_server_cert(name, new_path=new_path)
-                module.exit_json(changed=changed, name=new_name,
-                                 original_path=opath, new_path=new_path, cert_body=ocert,
-                                 upload_date=upload_date, expiration_date=exp)
+        digests = cache['digests'] if cache is not None else {}
+        existing_name = dup_check(module, name, new_name, cert, orig_cert_names,
+                                  cert_digest_getter(get_cert, digests), dup_ok)
+        if existing_name is not None:
+            if existing_name != name:
+                # only new_name exists, so an earlier run already did the rename
+                name, new_name = existing_name, None
+            opath, ocert, ocert_id, upload_date, exp = cert_meta(get_cert, name)
+            if new_path == opath:
+                new_path = None
+            update_args = dict()
+            result = dict(cert_body=ocert, upload_date=upload_date, expiration_date=exp)
+            if new_name:
+                update_args['NewServerCertificateName'] = new_name
+                result.update(original_name=name, new_name=new_name)
+            else:
+                result['name'] = name
+            if new_path:
+                update_args['NewPath'] = new_path
+                result.update(original_path=opath, new_path=new_path)
+            else:
+                result['cert_path'] = opath
+
+            if update_args:
+                changed=True
+                iam.update_server_certificate(ServerCertificateName=name, **update_args)
+                if new_name:
+                    record_change(cache, removed=[name], added={new_name: digests.get(name)})
             else:
                 changed=False
-                module.exit_json(changed=changed, name=name, cert_path=opath, cert_body=ocert,
-                                 upload_date=upload_date, expiration_date=exp,
-                                 msg='No new path or name specified. No changes made')
+                result['msg'] = 'No new path or name specified. No changes made'
         else:
             changed=True
-            iam.upload_server_cert(name, cert, key, cert_chain=chain, path=cpath)
-            opath, ocert, ocert_id, upload_date, exp = cert_meta(iam, name)
-            module.exit_json(changed=changed, name=name, cert_path=opath, cert_body=ocert,
-                                 upload_date=upload_date, expiration_date=exp)
+            upload_args = dict(ServerCertificateName=name, CertificateBody=cert, PrivateKey=key, Path=cpath)
+            if chain is not None:
+                upload_args['CertificateChain'] = chain
+            metadata = iam.upload_server_certificate(**upload_args)['ServerCertificateMetadata']
+            record_change(cache, added={name: cert_digest(cert)})
+            # the upload response already holds the metadata, and the body is the one just uploaded
+            result = dict(name=name, cert_path=metadata['Path'], cert_body=cert,
+                          upload_date=metadata['UploadDate'], expiration_date=metadata['Expiration'])
     elif state == 'absent':
         if name in orig_cert_names:
             changed=True
-            iam.delete_server_cert(name)
-            module.exit_json(changed=changed, deleted_cert=name)
+            iam.delete_server_certificate(ServerCertificateName=name)
+            record_change(cache, removed=[name])
+            result = dict(deleted_cert=name)
         else:
             changed=False
-            module.exit_json(changed=changed, msg='Certificate with the name %s already absent' % name)
+            result = dict(msg='Certificate with the name %s already absent' % name)
+
+    module.exit_json(changed=changed, **result)
 
 def main():
     argument_spec = ec2_argument_spec()
@@ -230,7 +389,8 @@ def main():
         new_name=dict(default=None, required=False),
         path=dict(default='/', required=False),
         new_path=dict(default=None, required=False),
-        dup_ok=dict(default=False, required=False, type='bool')
+        dup_ok=dict(default=False, required=False, type='bool'),
+        cache_ttl=dict(default=0, required=False, type='int'),
     )
     )
 
@@ -239,44 +399,24 @@ def main():
         mutually_exclusive=[],
     )
 
-    if not HAS_BOTO:
-        module.fail_json(msg="Boto is required for this module")
-
-    region, ec2_url, aws_connect_kwargs = get_aws_connection_info(module)
+    if not HAS_BOTO3:
+        module.fail_json(msg="boto3 and botocore are required for this module")
 
-    try:
-        if region:
-            iam = connect_to_aws(boto.iam, region, **aws_connect_kwargs)
-        else:
-            iam = boto.iam.connection.IAMConnection(**aws_connect_kwargs)
-    except boto.exception.NoAuthHandlerFound as e:
-        module.fail_json(msg=str(e))
+    region, ec2_url, aws_connect_kwargs = get_aws_connection_info(module, boto3=True)
+    # a single client is shared by every call below, including the threads fetching certificate bodies
+    iam = boto3_conn(module, conn_type='client', resource='iam', region=region, **aws_connect_kwargs)
 
     state = module.params.get('state')
     name = module.params.get('name')
     path = module.params.get('path')
     new_name = module.params.get('new_name')
     new_path = module.params.get('new_path')
+    cert = module.params.get('cert')
+    key = module.params.get('key')
     cert_chain = module.params.get('cert_chain')
     dup_ok = module.params.get('dup_ok')
-    if state == 'present':
-        if module.params.get('cert') is not None:
-            cert = module.params.get('cert')
-        if module.params.get('key') is not None:
-            key = module.params.get('key')
-        if module.params.get('cert_chain') is not None:
-            cert_chain = module.params.get('cert_chain')
-    else:
-        key=cert=chain=None
-
-    orig_certs = [ctb['server_certificate_name'] for ctb in \
-                                                    iam.get_all_server_certs().\
-                                                    list_server_certificates_result.\
-                                                    server_certificate_metadata_list]
-    orig_bodies = [iam.get_server_certificate(thing).\
-                  get_server_certificate_result.\
-                  certificate_body \
-                  for thing in orig_certs]
+    cache_ttl = module.params.get('cache_ttl')
+
     if new_name == name:
         new_name = None
     if new_path == path:
@@ -284,14 +424,35 @@ def main():
 
     changed = False
     try:
-        cert_action(module, iam, name, path, new_name, new_path, state,
-                cert, key, cert_chain, orig_certs, orig_bodies, dup_ok)
-    except boto.exception.BotoServerError as err:
-        module.fail_json(changed=changed, msg=str(err), debug=[cert,key])
+        cache = None
+        orig_certs = None
+        if cache_ttl > 0:
+            try:
+                sts = boto3_conn(module, conn_type='client', resource='sts', region=region, **aws_connect_kwargs)
+                account_id = sts.get_caller_identity()['Account']
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as err:
+                module.warn('Unable to look up the AWS account the certificate cache belongs to, '
+                            'so cache_ttl is ignored: %s' % to_native(err))
+            else:
+                cache = load_cache(cache_path(account_id), cache_ttl)
+                orig_certs = cache['names']
+        if orig_certs is None and cache is None:
+            # once name is listed neither dup_check nor the absent state look at any other certificate
+            orig_certs = list_cert_names(iam, stop_at=name)
+        elif orig_certs is None:
+            orig_certs = list_cert_names(iam)
+            save_listing(cache, orig_certs)
+        # certificates are fetched on demand, and once per run; the absent state never needs them
+        get_cert = cert_getter(iam)
 
+        cert_action(module, iam, name, path, new_name, new_path, state,
+                cert, key, cert_chain, orig_certs, get_cert, dup_ok, cache)
+    except botocore.exceptions.ClientError as err:
+        module.fail_json(changed=changed, msg=str(err), exception=traceback.format_exc(),
+                         **camel_dict_to_snake_dict(err.response))
+    except (botocore.exceptions.ParamValidationError, botocore.exceptions.NoCredentialsError) as err:
+        module.fail_json(changed=changed, msg=str(err), exception=traceback.format_exc())
 
-from ansible.module_utils.basic import *
-from ansible.module_utils.ec2 import *
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,311 @@
+import errno
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ansible.compat.tests.mock import patch
+
+import ansible.modules.cloud.amazon.iam_cert as iam_cert
+
+
+CERT = '-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----'
+OTHER_CERT = '-----BEGIN CERTIFICATE-----\nMIIC\n-----END CERTIFICATE-----'
+
+
+class FailJson(Exception):
+    pass
+
+
+class FakeModule(object):
+
+    def __init__(self):
+        self.exits = []
+
+    def fail_json(self, **kwargs):
+        raise FailJson(kwargs['msg'])
+
+    def exit_json(self, **kwargs):
+        self.exits.append(kwargs)
+
+
+class FakePaginator(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self):
+        for number, page in enumerate(self.client.pages):
+            self.client.pages_requested.append(number)
+            yield {'ServerCertificateMetadataList': [{'ServerCertificateName': name} for name in page]}
+
+
+class FakeIAM(object):
+    '''stands in for the boto3 IAM client, holding certificate bodies by name split into listing pages'''
+
+    def __init__(self, pages, bodies):
+        self.pages = pages
+        self.bodies = bodies
+        self.pages_requested = []
+        self.fetched = []
+        self.calls = []
+
+    def get_paginator(self, operation):
+        assert operation == 'list_server_certificates'
+        return FakePaginator(self)
+
+    def get_server_certificate(self, ServerCertificateName):
+        self.fetched.append(ServerCertificateName)
+        metadata = {'Path': '/', 'ServerCertificateId': 'ID' + ServerCertificateName,
+                    'UploadDate': 'uploaded', 'Expiration': 'expires'}
+        return {'ServerCertificate': {'CertificateBody': self.bodies[ServerCertificateName],
+                                      'ServerCertificateMetadata': metadata}}
+
+    def update_server_certificate(self, **kwargs):
+        self.calls.append(('update', kwargs))
+
+    def upload_server_certificate(self, **kwargs):
+        self.calls.append(('upload', kwargs))
+        return {'ServerCertificateMetadata': {'Path': kwargs['Path'], 'ServerCertificateId': 'IDnew',
+                                              'UploadDate': 'just now', 'Expiration': 'later'}}
+
+    def delete_server_certificate(self, **kwargs):
+        self.calls.append(('delete', kwargs))
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'iam_cert_cache_123456789012.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+
+    def assert_empty(self, cache):
+        self.assertEqual(cache['serial'], 0)
+        self.assertIsNone(cache['names'])
+        self.assertEqual(cache['digests'], {})
+
+    def test_load_missing(self):
+        self.assert_empty(iam_cert.load_cache(self.path, 60))
+
+    def test_load_corrupt(self):
+        self.write('{"created": ')
+        self.assert_empty(iam_cert.load_cache(self.path, 60))
+        self.write('{"created": %f}' % time.time())
+        self.assert_empty(iam_cert.load_cache(self.path, 60))
+        self.write('[]')
+        self.assert_empty(iam_cert.load_cache(self.path, 60))
+
+    def test_load_expired(self):
+        self.write(json.dumps(dict(created=time.time() - 120, serial=3, names=['a'], digests={'a': 'x'})))
+        self.assert_empty(iam_cert.load_cache(self.path, 60))
+
+    def test_load_fresh(self):
+        self.write(json.dumps(dict(created=time.time(), serial=3, names=['a'], digests={'a': 'x'})))
+        cache = iam_cert.load_cache(self.path, 60)
+        self.assertEqual(cache['serial'], 3)
+        self.assertEqual(cache['names'], ['a'])
+        self.assertEqual(cache['digests'], {'a': 'x'})
+
+    def test_save_listing(self):
+        cache = iam_cert.load_cache(self.path, 60)
+        iam_cert.save_listing(cache, ['a', 'b'])
+        self.assertEqual(iam_cert.load_cache(self.path, 60)['names'], ['a', 'b'])
+
+    def test_save_listing_skipped_after_concurrent_change(self):
+        iam_cert.save_listing(iam_cert.load_cache(self.path, 60), ['a', 'b'])
+        cache = iam_cert.load_cache(self.path, 60)
+        iam_cert.record_change(iam_cert.load_cache(self.path, 60), removed=['a'])
+        iam_cert.save_listing(cache, ['a', 'b'])
+        self.assertEqual(iam_cert.load_cache(self.path, 60)['names'], ['b'])
+
+    def test_record_change_removed_and_added(self):
+        cache = iam_cert.load_cache(self.path, 60)
+        iam_cert.save_listing(cache, ['a', 'b'])
+        cache['digests'].update(a='digest-a', b='digest-b')
+        iam_cert.record_change(cache, removed=['a'], added={'c': 'digest-c', 'd': None})
+
+        stored = iam_cert.load_cache(self.path, 60)
+        self.assertEqual(sorted(stored['names']), ['b', 'c', 'd'])
+        self.assertEqual(stored['digests'], {'b': 'digest-b', 'c': 'digest-c'})
+
+    def test_record_change_added_already_listed(self):
+        iam_cert.save_listing(iam_cert.load_cache(self.path, 60), ['a', 'b'])
+        iam_cert.record_change(iam_cert.load_cache(self.path, 60), added={'b': 'digest-b'})
+        self.assertEqual(iam_cert.load_cache(self.path, 60)['names'], ['a', 'b'])
+
+    def test_record_change_without_listing(self):
+        iam_cert.record_change(iam_cert.load_cache(self.path, 60), added={'c': 'digest-c'})
+        self.assertIsNone(iam_cert.load_cache(self.path, 60)['names'])
+
+    def test_record_change_keeps_concurrent_forget(self):
+        cache = iam_cert.load_cache(self.path, 60)
+        cache['digests'].update(a='digest-a', b='digest-b')
+        iam_cert.record_change(cache)
+
+        first = iam_cert.load_cache(self.path, 60)
+        second = iam_cert.load_cache(self.path, 60)
+        iam_cert.record_change(second, removed=['a'])
+        first['digests']['d'] = 'digest-d'
+        iam_cert.record_change(first, added={'c': 'digest-c'})
+
+        self.assertEqual(iam_cert.load_cache(self.path, 60)['digests'], {'b': 'digest-b', 'c': 'digest-c'})
+
+    def test_record_change_lock_failure(self):
+        cache = iam_cert.load_cache(self.path, 60)
+        with patch.object(iam_cert.fcntl, 'flock', side_effect=IOError(errno.ENOLCK, 'No locks available')):
+            iam_cert.record_change(cache, removed=['a'])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_record_change_without_cache(self):
+        iam_cert.record_change(None, removed=['a'])
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestListCertNames(unittest.TestCase):
+
+    def setUp(self):
+        self.iam = FakeIAM([['a', 'b'], ['c', 'd'], ['e']], {})
+
+    def test_stops_at_page_with_name(self):
+        self.assertEqual(iam_cert.list_cert_names(self.iam, stop_at='c'), ['a', 'b', 'c'])
+        self.assertEqual(self.iam.pages_requested, [0, 1])
+
+    def test_lists_everything_without_match(self):
+        self.assertEqual(iam_cert.list_cert_names(self.iam, stop_at='z'), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(self.iam.pages_requested, [0, 1, 2])
+
+    def test_lists_everything_without_stop_at(self):
+        self.assertEqual(iam_cert.list_cert_names(self.iam), ['a', 'b', 'c', 'd', 'e'])
+
+
+class TestDupCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.iam = FakeIAM([['existing', 'other']], {'existing': CERT, 'other': OTHER_CERT})
+
+    def dup_check(self, name, cert, new_name=None, dup_ok=False):
+        get_cert_digest = iam_cert.cert_digest_getter(iam_cert.cert_getter(self.iam), {})
+        return iam_cert.dup_check(FakeModule(), name, new_name, cert, ['existing', 'other'], get_cert_digest, dup_ok)
+
+    def test_same_name_same_body(self):
+        self.assertEqual(self.dup_check('existing', CERT), 'existing')
+        self.assertEqual(self.iam.fetched, ['existing'])
+
+    def test_same_name_different_body(self):
+        self.assertRaisesRegexp(FailJson, 'A cert with the name existing already exists',
+                                self.dup_check, 'existing', OTHER_CERT)
+
+    def test_same_name_without_cert(self):
+        self.assertEqual(self.dup_check('existing', None), 'existing')
+        self.assertEqual(self.iam.fetched, [])
+
+    def test_equivalent_bodies(self):
+        for cert in (CERT.replace('\n', '\r\n'), u'\ufeff' + CERT, CERT + '\n\n', '  ' + CERT + ' \n'):
+            self.assertEqual(self.dup_check('existing', cert), 'existing')
+
+    def test_new_name_without_duplicate(self):
+        self.assertIsNone(self.dup_check('new', '-----BEGIN CERTIFICATE-----\nMIID\n-----END CERTIFICATE-----'))
+
+    def test_duplicate_under_other_name(self):
+        self.assertRaisesRegexp(FailJson, 'already exists under the name other',
+                                self.dup_check, 'new', OTHER_CERT + '\r\n')
+
+    def test_duplicate_under_other_name_dup_ok(self):
+        self.assertIsNone(self.dup_check('new', OTHER_CERT, dup_ok=True))
+        self.assertEqual(self.iam.fetched, [])
+
+    def test_new_name_collision_same_body(self):
+        self.assertEqual(self.dup_check('new', CERT, new_name='existing'), 'existing')
+
+    def test_new_name_collision_different_body(self):
+        self.assertRaisesRegexp(FailJson, 'A cert with the name other already exists',
+                                self.dup_check, 'new', CERT, new_name='other')
+
+    def test_name_checked_before_new_name(self):
+        self.assertEqual(self.dup_check('existing', CERT, new_name='other'), 'existing')
+
+
+class TestCertAction(unittest.TestCase):
+
+    def setUp(self):
+        self.iam = FakeIAM([['existing', 'other']], {'existing': CERT, 'other': OTHER_CERT})
+        self.module = FakeModule()
+
+    def cert_action(self, name, cert, new_name=None, new_path=None, state='present', chain=None):
+        iam_cert.cert_action(self.module, self.iam, name, '/', new_name, new_path, state, cert, 'KEY', chain,
+                             ['existing', 'other'], iam_cert.cert_getter(self.iam), False)
+        self.assertEqual(len(self.module.exits), 1)
+        return self.module.exits[0]
+
+    def test_rename_and_move(self):
+        result = self.cert_action('existing', CERT, new_name='renamed', new_path='/new/')
+        self.assertEqual(self.iam.calls, [('update', dict(ServerCertificateName='existing',
+                                                          NewServerCertificateName='renamed', NewPath='/new/'))])
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['original_name'], 'existing')
+        self.assertEqual(result['new_name'], 'renamed')
+        self.assertEqual(result['original_path'], '/')
+        self.assertEqual(result['new_path'], '/new/')
+        self.assertEqual(result['cert_body'], CERT)
+        self.assertEqual(result['upload_date'], 'uploaded')
+        self.assertEqual(result['expiration_date'], 'expires')
+
+    def test_move_only(self):
+        result = self.cert_action('existing', None, new_path='/new/')
+        self.assertEqual(self.iam.calls, [('update', dict(ServerCertificateName='existing', NewPath='/new/'))])
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['name'], 'existing')
+        self.assertEqual(result['new_path'], '/new/')
+        self.assertNotIn('new_name', result)
+
+    def test_nothing_to_update(self):
+        result = self.cert_action('existing', CERT)
+        self.assertEqual(self.iam.calls, [])
+        self.assertFalse(result['changed'])
+        self.assertEqual(result['name'], 'existing')
+        self.assertEqual(result['cert_path'], '/')
+
+    def test_upload(self):
+        result = self.cert_action('new', '-----BEGIN CERTIFICATE-----\nMIID\n-----END CERTIFICATE-----')
+        self.assertEqual([call[0] for call in self.iam.calls], ['upload'])
+        self.assertNotIn('CertificateChain', self.iam.calls[0][1])
+        self.assertEqual(sorted(self.iam.fetched), ['existing', 'other'])
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['name'], 'new')
+        self.assertEqual(result['cert_path'], '/')
+        self.assertEqual(result['cert_body'], '-----BEGIN CERTIFICATE-----\nMIID\n-----END CERTIFICATE-----')
+        self.assertEqual(result['upload_date'], 'just now')
+        self.assertEqual(result['expiration_date'], 'later')
+
+    def test_upload_with_chain(self):
+        self.cert_action('new', '-----BEGIN CERTIFICATE-----\nMIID\n-----END CERTIFICATE-----', chain='CHAIN')
+        self.assertEqual(self.iam.calls[0][1]['CertificateChain'], 'CHAIN')
+
+    def test_delete(self):
+        result = self.cert_action('existing', None, state='absent')
+        self.assertEqual(self.iam.calls, [('delete', dict(ServerCertificateName='existing'))])
+        self.assertEqual(result, dict(changed=True, deleted_cert='existing'))
+
+    def test_delete_already_absent(self):
+        result = self.cert_action('gone', None, state='absent')
+        self.assertEqual(self.iam.calls, [])
+        self.assertFalse(result['changed'])
+
+    def test_rename_already_done(self):
+        for cert in (CERT, None):
+            self.module.exits = []
+            result = self.cert_action('gone', cert, new_name='existing')
+            self.assertFalse(result['changed'])
+            self.assertEqual(result['name'], 'existing')
+            self.assertEqual(result['cert_path'], '/')
+            self.assertEqual(result['cert_body'], CERT)
+            self.assertEqual(self.iam.calls, [])